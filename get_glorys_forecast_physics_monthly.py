@@ -26,28 +26,29 @@
 #  		- the name of the OUTPUT_DIRECTORY where the glorys data will be saved as output
 # 		- the date_start and number_of_months of the period to be extracted (between 11/2020 and preseent)
 #       - the min and max depths (dep_min and dep_max) (between 0 and 5728m)
+#       - the number_of_workers, which is the number of files that are downloaded at the same time (default 6)
 # 2) Run this script in python or ipython
+#    (add --resume to skip the nc files that were already downloaded by a previous run, e.g. python script.py --resume or %run script.py --resume)
 # 3) Enter your username and password when prompted
 # 4) During execution you sould see the progress of each monthly file that is extracted during the period of interest 
 #    from beginning to end. Each nc file name has the format glorys_yyyy_MM.nc to indicate the date stamp
 #
 # - - -
-# This python script uses the manual dictionary method that is described at the following Web page:
-# https://help.marine.copernicus.eu/en/articles/5211063-how-to-use-the-motuclient-within-python-environment
+# This python script uses the open_dataset function of the Copernicus Marine Toolbox (copernicusmarine), which replaced motuclient in 2024,
+# to open the GLORYS data lazily from the ARCO (Zarr) store of the Copernicus Marine service. The data are only downloaded when they are read,
+# and the data of each nc file are saved with one request.
+# The documentation of the Copernicus Marine Toolbox is available at the following Web page:
+# https://toolbox-docs.marine.copernicus.eu/
 #
 # - - -
-# Notes for installing motuclient if you have not yet installed it:
+# Notes for installing the Copernicus Marine Toolbox if you have not yet installed it:
 #
-#      $ python -m pip install --upgrade motuclient
-#   Otherwise (if there is no previous installation of motuclient), 
+#      $ python -m pip install copernicusmarine
+#   Otherwise (if there is a previous installation of copernicusmarine older than v2.0), 
 #   type in the following:
-#      $ python -m pip install motuclient
-#   That command should install and display motuclient package v1.8.8 
+#      $ python -m pip install --upgrade copernicusmarine
 #   To display the version:
-#      $ python -m motuclient --version
-#   If that command does not return: "motuclient-python v1.8.X" ("X" >= "8"), 
-#   then type in the following:
-#     $ python -m pip install motuclient==1.8.8
+#      $ copernicusmarine --version
 
 # - - -
 # IMPORT REQUIRED PYTHON PACKAGES
@@ -56,13 +57,20 @@ import os
 import sys
 from datetime import *
 import time
+import random
 from socket import timeout
-from dateutil.relativedelta import relativedelta
-import calendar     # calendar.monthrange(year, month) returns weekday (0-6 ~ Mon-Sun) and number of days (28-31) for year, month.
+import json
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import pandas as pd
 
-# aditional packages needed per https://help.marine.copernicus.eu/en/articles/5211063-how-to-use-the-motuclient-within-python-environment:
+# aditional packages needed to download from https://data.marine.copernicus.eu/ with the Copernicus Marine Toolbox:
 import getpass
-import motuclient
+import copernicusmarine
+import requests                 # requests, urllib3, and botocore are installed with copernicusmarine, and are imported for their network exceptions
+import urllib3
+import botocore.exceptions
+import xarray as xr
 
 # ----------
 
@@ -103,6 +111,10 @@ number_of_months = 12
 dep_min = 0
 dep_max = 5728
 
+# -  
+# Specify the number of files to download at the same time (capped at 8 to avoid overloading the Copernicus server)
+number_of_workers = max(1, min(int(os.environ.get('GLORYS_WORKERS', '6')), 8))
+
 
 # END OF USER INPUTS
 # ----------
@@ -118,123 +130,200 @@ def ensure_dir(file_path):
     if not os.path.exists(directory):
         os.makedirs(directory)
 
-# define a class MotuOptions that will be used to parse the motuclient 
-class MotuOptions:
-    def __init__(self, attrs: dict):
-        super(MotuOptions, self).__setattr__("attrs", attrs)
+# make function to check if an nc file was completely downloaded by a previous run, as recorded in the manifest
+def in_manifest(manifest, directory, fn, fn_vars):
+    if (fn not in manifest) or (manifest[fn]['vars'] != fn_vars):
+        return False
+    full_path = os.path.join(directory, fn)
+    return os.path.isfile(full_path) and (os.path.getsize(full_path) == manifest[fn]['size'])
 
-    def __setattr__(self, k, v):
-        self.attrs[k] = v
+# make function to save the manifest (written to a temporary file first so that an interrupted run can not corrupt it)
+def save_manifest(manifest, manifest_fn):
+    with open(manifest_fn + '.tmp', 'w') as fm:
+        json.dump(manifest, fm, indent=1)
+    os.replace(manifest_fn + '.tmp', manifest_fn)
 
-    def __getattr__(self, k):
-        try:
-            return self.attrs[k]
-        except KeyError:
-            return None
+# - - -
+# random number generator for the retry delays (SystemRandom so that the parallel workers do not retry in sync)
+jitter = random.SystemRandom()
+
+# event that is set when the run is interrupted with Ctrl-C, so that the running workers of the thread pool stop at the next nc file or retry
+stop_event = threading.Event()
 
 # - - -
 # make function to extract the glorys data during the loop through all datetimes
-def get_extraction(data_request_options_dict):
-    # get the data and save as a netcdf file
+def get_extraction(ds, directory, out_names, time_slices):
+    # save the data of the lazy dataset ds to disk with one request to the server (written as it is read, so that the data are not all held in memory),
+    # and if there are several out_names, split that temporary nc file into a netcdf file for each time slice,
+    # waiting longer after each failed attempt (capped exponential backoff with jitter).
+    # All of the nc files of one request go through the same error handling, and the next attempt only saves the nc files that are still missing
+    results = ['fail'] * len(out_names)
+    label = out_names[0] if len(out_names) == 1 else out_names[0] + ' to ' + out_names[-1]
+    # compress each variable with zlib level 4 after the shuffle filter, which reorders the bytes by significance before deflate
+    # and typically makes the nc files of the ocean fields 2-4 times smaller at negligible CPU cost
+    encoding = {v: {'zlib': True, 'complevel': 4, 'shuffle': True} for v in ds.data_vars}
+    if len(out_names) == 1:
+        read_fn = directory + out_names[0] + '.part'        # one nc file is written directly from the lazy dataset
+    else:
+        read_fn = directory + out_names[0] + '.chunk.part'  # temporary nc file of the whole request that is split into the nc files of each time slice
     counter = 1
-    got_file = False
-    while (counter <= 10) and (got_file == False):
-        print('  Attempting to get data, counter = ' + str(counter))
+    max_tries = 10
+    t0 = 1.0                                    # first delay of the backoff (set again by each kind of error)
+    got_data = False                            # True when the data are saved in read_fn, which is kept for the next attempts if splitting it fails
+    while (counter <= max_tries) and ('fail' in results) and not stop_event.is_set():
+        print('  ' + label + ': Attempting to get data, counter = ' + str(counter))
         tt0 = time.time()
         try:
-            motuclient.motu_api.execute_request(MotuOptions(data_request_options_dict))
-        except timeout:
-            print('  *Socket timed out, trying again')
-        except:
-            print('  *Something went wrong, trying again')      
+            if not got_data:
+                ds.to_netcdf(read_fn, encoding=encoding)
+                got_data = True
+                print('  ' + label + ': Downloaded data')
+            if len(out_names) == 1:
+                os.replace(read_fn, directory + out_names[0])   # atomic rename to the final nc file (also replaces an existing nc file)
+                results[0] = 'success'
+            else:
+                # read the temporary nc file back from disk one time slice at a time
+                with xr.open_dataset(read_fn) as ds_chunk:
+                    for i, (out_name, time_slice) in enumerate(zip(out_names, time_slices)):
+                        if (results[i] == 'success') or stop_event.is_set():
+                            continue
+                        part_fn = directory + out_name + '.part'    # write to a temporary .part file first, so that an interrupted download never leaves a partial nc file with the final name
+                        ds_chunk.sel(time=time_slice).to_netcdf(part_fn, encoding=encoding)
+                        os.replace(part_fn, directory + out_name)   # atomic rename to the final nc file (also replaces an existing nc file)
+                        results[i] = 'success'
+        except (timeout, ConnectionError, TimeoutError, requests.exceptions.RequestException, urllib3.exceptions.HTTPError,
+                botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError) as e:
+            if isinstance(e, botocore.exceptions.ClientError):
+                status = e.response.get('ResponseMetadata', {}).get('HTTPStatusCode')     # S3 error of the ARCO store
+            else:
+                status = getattr(getattr(e, 'response', None), 'status_code', None)     # HTTP error of requests (None for other network errors)
+            if status in (400, 401, 403, 404):
+                print('  ' + label + ': *Request refused by the server (HTTP ' + str(status) + '): ' + str(e))
+                max_tries = counter             # bad credentials or request options are not transient, so do not try again
+            else:
+                print('  ' + label + ': *Network error: ' + repr(e))
+                t0 = 1.0                        # timeouts, dropped connections, and HTTP 429 or 5xx responses are usually transient, so start with short delays
+        except Exception as e:
+            print('  ' + label + ': *Something went wrong: ' + repr(e))
+            max_tries = counter                 # other errors (e.g. bad request options or a full disk) fail the same way every time, so do not try again
         else:
-            got_file = True
-            print('  Downloaded data')
-        print('  Time elapsed: %0.1f seconds' % (time.time() - tt0))
+            if 'fail' in results:
+                print('  ' + label + ': Stopped before all of the nc files were saved')
+            else:
+                print('  ' + label + ': Saved nc files')
+        print('  ' + label + ': Time elapsed: %0.1f seconds' % (time.time() - tt0))
+        if ('fail' in results) and (counter < max_tries) and not stop_event.is_set():
+            delay = min(300.0, t0 * 2**(counter-1)) * jitter.uniform(0.5, 1.5)
+            print('  ' + label + ': Trying again in %0.1f seconds' % delay)
+            stop_event.wait(delay)                # sleep, but wake up at once if the run is interrupted
         counter += 1
-    if got_file:
-        result = 'success'
-    else:
-        result = 'fail'
-    return result
+    # remove the temporary nc file of the request and the .part files of the nc files that could not be saved, so that they are not left in the output directory
+    tmp_fns = [read_fn] + [directory + out_name + '.part' for out_name, result in zip(out_names, results) if result == 'fail']
+    for tmp_fn in tmp_fns:
+        try:
+            os.remove(tmp_fn)
+        except FileNotFoundError:
+            pass
+    return results
 
 # - - -
 # make monthly dt_list to extract from glorys
 base = datetime.fromisoformat(date_start)
 ndt = number_of_months
-dt_list = []
-dt_list = [base + relativedelta(months = x) for x in range(ndt)]
+dt_list = pd.date_range(base.replace(day=1), periods=ndt, freq='MS')     # MS = first day of each month
+
+# make the datetime strings of the first and last day of every month all at once
+dstr_min_list = dt_list.strftime('%Y-%m-%d 00:00:00')
+dstr_max_list = (dt_list + pd.offsets.MonthEnd(1)).strftime('%Y-%m-%d 23:59:59')
+
+# filename stem and dataset_id of the variable in var_list, which are the same for all of the dates
+FN_STEM = {'so': 'glorys_so', 'thetao': 'glorys_thetao', 'uo': 'glorys_uovo', 'vo': 'glorys_uovo', 'zos': 'glorys_zos'}[var_list[0]]
+DATASET_ID = {
+    'so': "cmems_mod_glo_phy-so_anfc_0.083deg_P1M-m",
+    'thetao': "cmems_mod_glo_phy-thetao_anfc_0.083deg_P1M-m",
+    'uo': "cmems_mod_glo_phy-cur_anfc_0.083deg_P1M-m",
+    'vo': "cmems_mod_glo_phy-cur_anfc_0.083deg_P1M-m",
+    'zos': "cmems_mod_glo_phy_anfc_0.083deg_P1M-m"
+}[var_list[0]]
+
+# make the nc file names of every month all at once
+out_fn_list = dt_list.strftime(FN_STEM + '_%Y_%m.nc')
 
 # prompt for the user name and password of the user account at https://data.marine.copernicus.eu/products
 USERNAME = input('Enter your username: ')
 PASSWORD = getpass.getpass('Enter your password: ')
 
-# template dict that will be updated with new dates and output filenames during each iteration of the loop through dates
+# log in once before the loop so that the credentials are checked and cached for all of the downloads
+if not copernicusmarine.login(username=USERNAME, password=PASSWORD, force_overwrite=True):
+    sys.exit('Login to https://data.marine.copernicus.eu/ failed, check your username and password')
+
+# options to open the dataset, subset to the bounding box, depths, and whole period of dt_list
 data_request_options_dict_manual = {
-    "service_id": "GLOBAL_ANALYSISFORECAST_PHY_001_024-TDS",
-    "product_id": " ",
-    "date_min": " ",
-    "date_max": " ",
-    "longitude_min": float(west),
-    "longitude_max": float(east),
-    "latitude_min": float(south),
-    "latitude_max": float(north),
-    "depth_min": float(dep_min),
-    "depth_max": float(dep_max),
-    "variable": var_list,
-    "motu": "https://nrt.cmems-du.eu/motu-web/Motu",
-    "out_dir": OUTPUT_DIRECTORY,
-    "out_name": " ",
-    "auth_mode": "cas",
-    "user": USERNAME,
-    "pwd": PASSWORD
+    "dataset_id": DATASET_ID,
+    "variables": var_list,
+    "minimum_longitude": float(west),
+    "maximum_longitude": float(east),
+    "minimum_latitude": float(south),
+    "maximum_latitude": float(north),
+    "minimum_depth": float(dep_min),
+    "maximum_depth": float(dep_max),
+    "start_datetime": dstr_min_list[0],
+    "end_datetime": dstr_max_list[-1],
+    "username": USERNAME,
+    "password": PASSWORD
 }
 
-if var_list[0] == 'so':
-    data_request_options_dict_manual["product_id"] = "cmems_mod_glo_phy-so_anfc_0.083deg_P1M-m"
-elif var_list[0] == 'thetao':
-    data_request_options_dict_manual["product_id"] = "cmems_mod_glo_phy-thetao_anfc_0.083deg_P1M-m"
-elif var_list[0] == 'uo' or var_list[0] == 'vo':
-    data_request_options_dict_manual["product_id"] = "cmems_mod_glo_phy-cur_anfc_0.083deg_P1M-m"
-elif var_list[0] == 'zos':
-    data_request_options_dict_manual["product_id"] = "cmems_mod_glo_phy_anfc_0.083deg_P1M-m"
-
 # - - -
-# loop over all datetimes in dt_list
+# loop over all datetimes in dt_list, downloading number_of_workers files at the same time
 out_dir = OUTPUT_DIRECTORY                   # specify output directory adding the ending '/'
 ensure_dir(out_dir)                         # make sure the output directory exists, make one if not
 f = open(out_dir + 'log.txt', 'w+')         # open log of successful downloads
 print('\n** Working on GLORYS extraction **')
 f.write('\n\n** Working on GLORYS extraction **')
 tt1 = time.time()                           # tic for total elapsed time
-force_overwrite = True                      # overwrite any already existing nc files in the output folder that have the same names
-for dt in dt_list:
-
-    if var_list[0] == 'so':
-        out_fn = datetime.strftime(dt, 'glorys_so_%Y_%m') + '.nc'
-    elif var_list[0] == 'thetao':
-        out_fn = datetime.strftime(dt, 'glorys_thetao_%Y_%m') + '.nc'
-    elif var_list[0] == 'uo' or var_list[0] == 'vo':
-        out_fn = datetime.strftime(dt, 'glorys_uovo_%Y_%m') + '.nc'
-    elif var_list[0] == 'zos':
-        out_fn = datetime.strftime(dt, 'glorys_zos_%Y_%m') + '.nc'
-
-    dstr_min = dt.strftime('%Y-%m-01 00:00:00')
-    dd_str = str(calendar.monthrange(int(dt.strftime('%Y')), int(dt.strftime('%m')))[1])  # string of last day in this month
-    dstr_max = dt.strftime('%Y-%m-'+dd_str+' 23:59:59')
-
-    data_request_options_dict_manual["out_name"] = out_fn
-    data_request_options_dict_manual["date_min"] = dstr_min
-    data_request_options_dict_manual["date_max"] = dstr_max
+force_overwrite = '--resume' not in sys.argv    # overwrite any already existing nc files in the output folder that have the same names, unless the script is run with --resume
+
+# load the manifest of the nc files that were completely downloaded by previous runs, which are skipped when the script is run with --resume
+manifest_fn = out_dir + 'manifest.json'
+manifest = {}
+if os.path.isfile(manifest_fn):
+    with open(manifest_fn) as fm:
+        manifest = json.load(fm)
 
+# make function to save the nc file for one datetime, which is run by each worker of the thread pool
+def fetch_one(dt, dstr_min, dstr_max, out_fn):
     print(out_dir + out_fn)
-    if os.path.isfile(out_fn):
-        if force_overwrite:
-            os.remove(out_fn)
-    if not os.path.isfile(out_fn):
-        result = get_extraction(data_request_options_dict_manual)
-        f.write('\n ' + datetime.strftime(dt, '%Y_%m') + ' ' + result)
-            
+    result = None
+    new_files = []                              # nc files to add to the manifest
+    if force_overwrite or not in_manifest(manifest, out_dir, out_fn, var_list):
+        result = get_extraction(ds_glorys.sel(time=slice(dstr_min, dstr_max)), out_dir, [out_fn], [slice(dstr_min, dstr_max)])[0]
+        if result == 'success':
+            new_files.append([out_fn, var_list])
+    return dt, result, new_files
+
+# open the dataset once, before the thread pool starts, as a lazy xarray dataset from the ARCO (Zarr) store of the Copernicus Marine service.
+# This also sets up the login and connection to the server once for all of the workers, and each worker reads the data of its own nc file with one request
+ds_glorys = copernicusmarine.open_dataset(**data_request_options_dict_manual)
+
+ex = ThreadPoolExecutor(max_workers=number_of_workers)
+try:
+    for dt, result, new_files in ex.map(fetch_one, dt_list, dstr_min_list, dstr_max_list, out_fn_list):       # results are returned in the same order as dt_list
+        if result is not None:
+            f.write('\n ' + datetime.strftime(dt, '%Y_%m') + ' ' + result)
+        for fn, fn_vars in new_files:
+            full_path = os.path.join(out_dir, fn)
+            manifest[fn] = {'size': os.path.getsize(full_path), 'mtime': os.path.getmtime(full_path), 'vars': fn_vars}
+        if len(new_files) > 0:
+            save_manifest(manifest, manifest_fn)
+except KeyboardInterrupt:
+    # Ctrl-C only interrupts the main thread, so cancel the months that have not started yet and tell the running workers to stop
+    print('\n*Interrupted, stopping the workers of the thread pool')
+    stop_event.set()
+    ex.shutdown(wait=False, cancel_futures=True)
+    f.close()
+    raise
+ex.shutdown()
+
 # - - -
 # final message
 totmin = (time.time() - tt1)/60             # total time elapsed for loop over all datetimes in minutes
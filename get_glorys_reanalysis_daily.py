@@ -7,7 +7,7 @@
 #
 # This script is used to download from:
 
-# https://data.marine.copernicus.eu/product/GLOBAL_MULTIYEAR_PHY_001_030/download?dataset=cmems_mod_glo_phy_my_0.083_P1D-m
+# https://data.marine.copernicus.eu/product/GLOBAL_MULTIYEAR_PHY_001_030/download?dataset=cmems_mod_glo_phy_my_0.083deg_P1D-m
 
 # by Greg Pelletier | gjpelletier@gmail.com | https://github.com/gjpelletier/get_glorys
 # ----------
@@ -26,28 +26,30 @@
 #  		- the name of the OUTPUT_DIRECTORY where the glorys data will be saved as output
 # 		- the date_start and number_of_days of the period to be extracted (between 1/1/1993 and 12/31/2020)
 #       - the min and max depths (dep_min and dep_max) (between 0 and 5728m)
+#       - the number_of_workers, which is the number of files that are downloaded at the same time (default 6)
+#       - the chunk_days, which is the number of days downloaded in each request (default 30), and whether to split_daily the downloaded files
 # 2) Run this script in python or ipython
+#    (add --resume to skip the nc files that were already downloaded by a previous run, e.g. python script.py --resume or %run script.py --resume)
 # 3) Enter your username and password when prompted
 # 4) During execution you sould see the progress of each daily file that is extracted during the period of interest 
 #    from beginning to end. Each nc file name has the format glorys_yyyy_MM_dd.nc to indicate the date stamp
 #
 # - - -
-# This python script uses the manual dictionary method that is described at the following Web page:
-# https://help.marine.copernicus.eu/en/articles/5211063-how-to-use-the-motuclient-within-python-environment
+# This python script uses the open_dataset function of the Copernicus Marine Toolbox (copernicusmarine), which replaced motuclient in 2024,
+# to open the GLORYS data lazily from the ARCO (Zarr) store of the Copernicus Marine service. The data are only downloaded when they are read,
+# and each chunk of chunk_days is saved to a temporary nc file with one request and then split into the daily nc files locally.
+# The documentation of the Copernicus Marine Toolbox is available at the following Web page:
+# https://toolbox-docs.marine.copernicus.eu/
 #
 # - - -
-# Notes for installing motuclient if you have not yet installed it:
+# Notes for installing the Copernicus Marine Toolbox if you have not yet installed it:
 #
-#      $ python -m pip install --upgrade motuclient
-#   Otherwise (if there is no previous installation of motuclient), 
+#      $ python -m pip install copernicusmarine
+#   Otherwise (if there is a previous installation of copernicusmarine older than v2.0), 
 #   type in the following:
-#      $ python -m pip install motuclient
-#   That command should install and display motuclient package v1.8.4 (Oct. 2019). 
+#      $ python -m pip install --upgrade copernicusmarine
 #   To display the version:
-#      $ python -m motuclient --version
-#   If that command does not return: "motuclient-python v1.8.X" ("X" >= "4"), 
-#   then type in the following:
-#     $ python -m pip install motuclient==1.8.4
+#      $ copernicusmarine --version
 
 # - - -
 # IMPORT REQUIRED PYTHON PACKAGES
@@ -56,11 +58,20 @@ import os
 import sys
 from datetime import *
 import time
+import random
 from socket import timeout
+import json
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import pandas as pd
 
-# aditional packages needed per https://help.marine.copernicus.eu/en/articles/5211063-how-to-use-the-motuclient-within-python-environment:
+# aditional packages needed to download from https://data.marine.copernicus.eu/ with the Copernicus Marine Toolbox:
 import getpass
-import motuclient
+import copernicusmarine
+import requests                 # requests, urllib3, and botocore are installed with copernicusmarine, and are imported for their network exceptions
+import urllib3
+import botocore.exceptions
+import xarray as xr
 
 # ----------
 
@@ -105,6 +116,15 @@ number_of_days = 365
 dep_min = 0
 dep_max = 5728
 
+# -  
+# Specify the number of files to download at the same time (capped at 8 to avoid overloading the Copernicus server)
+number_of_workers = max(1, min(int(os.environ.get('GLORYS_WORKERS', '6')), 8))
+
+# -  
+# Specify the number of days in each chunk that is saved by one worker of the thread pool
+chunk_days = 30
+split_daily = True      # True = save a daily nc file for each day of the chunk, False = save one multi-day nc file for the whole chunk
+
 
 
 # END OF USER INPUTS
@@ -121,105 +141,222 @@ def ensure_dir(file_path):
     if not os.path.exists(directory):
         os.makedirs(directory)
 
-# define a class MotuOptions that will be used to parse the motuclient 
-class MotuOptions:
-    def __init__(self, attrs: dict):
-        super(MotuOptions, self).__setattr__("attrs", attrs)
+# make function to check if an nc file was completely downloaded by a previous run, as recorded in the manifest
+def in_manifest(manifest, directory, fn, fn_vars):
+    if (fn not in manifest) or (manifest[fn]['vars'] != fn_vars):
+        return False
+    full_path = os.path.join(directory, fn)
+    return os.path.isfile(full_path) and (os.path.getsize(full_path) == manifest[fn]['size'])
 
-    def __setattr__(self, k, v):
-        self.attrs[k] = v
+# make function to save the manifest (written to a temporary file first so that an interrupted run can not corrupt it)
+def save_manifest(manifest, manifest_fn):
+    with open(manifest_fn + '.tmp', 'w') as fm:
+        json.dump(manifest, fm, indent=1)
+    os.replace(manifest_fn + '.tmp', manifest_fn)
 
-    def __getattr__(self, k):
-        try:
-            return self.attrs[k]
-        except KeyError:
-            return None
+# - - -
+# random number generator for the retry delays (SystemRandom so that the parallel workers do not retry in sync)
+jitter = random.SystemRandom()
+
+# event that is set when the run is interrupted with Ctrl-C, so that the running workers of the thread pool stop at the next nc file or retry
+stop_event = threading.Event()
 
 # - - -
 # make function to extract the glorys data during the loop through all datetimes
-def get_extraction(data_request_options_dict):
-    # get the data and save as a netcdf file
+def get_extraction(ds, directory, out_names, time_slices):
+    # save the data of the lazy dataset ds to disk with one request to the server (written as it is read, so that the data are not all held in memory),
+    # and if there are several out_names, split that temporary nc file into a netcdf file for each time slice,
+    # waiting longer after each failed attempt (capped exponential backoff with jitter).
+    # All of the nc files of one request go through the same error handling, and the next attempt only saves the nc files that are still missing
+    results = ['fail'] * len(out_names)
+    label = out_names[0] if len(out_names) == 1 else out_names[0] + ' to ' + out_names[-1]
+    # compress each variable with zlib level 4 after the shuffle filter, which reorders the bytes by significance before deflate
+    # and typically makes the nc files of the ocean fields 2-4 times smaller at negligible CPU cost
+    encoding = {v: {'zlib': True, 'complevel': 4, 'shuffle': True} for v in ds.data_vars}
+    if len(out_names) == 1:
+        read_fn = directory + out_names[0] + '.part'        # one nc file is written directly from the lazy dataset
+    else:
+        read_fn = directory + out_names[0] + '.chunk.part'  # temporary nc file of the whole request that is split into the nc files of each time slice
     counter = 1
-    got_file = False
-    while (counter <= 10) and (got_file == False):
-        print('  Attempting to get data, counter = ' + str(counter))
+    max_tries = 10
+    t0 = 1.0                                    # first delay of the backoff (set again by each kind of error)
+    got_data = False                            # True when the data are saved in read_fn, which is kept for the next attempts if splitting it fails
+    while (counter <= max_tries) and ('fail' in results) and not stop_event.is_set():
+        print('  ' + label + ': Attempting to get data, counter = ' + str(counter))
         tt0 = time.time()
         try:
-            motuclient.motu_api.execute_request(MotuOptions(data_request_options_dict))
-        except timeout:
-            print('  *Socket timed out, trying again')
-        except:
-            print('  *Something went wrong, trying again')      
+            if not got_data:
+                ds.to_netcdf(read_fn, encoding=encoding)
+                got_data = True
+                print('  ' + label + ': Downloaded data')
+            if len(out_names) == 1:
+                os.replace(read_fn, directory + out_names[0])   # atomic rename to the final nc file (also replaces an existing nc file)
+                results[0] = 'success'
+            else:
+                # read the temporary nc file back from disk one time slice at a time
+                with xr.open_dataset(read_fn) as ds_chunk:
+                    for i, (out_name, time_slice) in enumerate(zip(out_names, time_slices)):
+                        if (results[i] == 'success') or stop_event.is_set():
+                            continue
+                        part_fn = directory + out_name + '.part'    # write to a temporary .part file first, so that an interrupted download never leaves a partial nc file with the final name
+                        ds_chunk.sel(time=time_slice).to_netcdf(part_fn, encoding=encoding)
+                        os.replace(part_fn, directory + out_name)   # atomic rename to the final nc file (also replaces an existing nc file)
+                        results[i] = 'success'
+        except (timeout, ConnectionError, TimeoutError, requests.exceptions.RequestException, urllib3.exceptions.HTTPError,
+                botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError) as e:
+            if isinstance(e, botocore.exceptions.ClientError):
+                status = e.response.get('ResponseMetadata', {}).get('HTTPStatusCode')     # S3 error of the ARCO store
+            else:
+                status = getattr(getattr(e, 'response', None), 'status_code', None)     # HTTP error of requests (None for other network errors)
+            if status in (400, 401, 403, 404):
+                print('  ' + label + ': *Request refused by the server (HTTP ' + str(status) + '): ' + str(e))
+                max_tries = counter             # bad credentials or request options are not transient, so do not try again
+            else:
+                print('  ' + label + ': *Network error: ' + repr(e))
+                t0 = 1.0                        # timeouts, dropped connections, and HTTP 429 or 5xx responses are usually transient, so start with short delays
+        except Exception as e:
+            print('  ' + label + ': *Something went wrong: ' + repr(e))
+            max_tries = counter                 # other errors (e.g. bad request options or a full disk) fail the same way every time, so do not try again
         else:
-            got_file = True
-            print('  Downloaded data')
-        print('  Time elapsed: %0.1f seconds' % (time.time() - tt0))
+            if 'fail' in results:
+                print('  ' + label + ': Stopped before all of the nc files were saved')
+            else:
+                print('  ' + label + ': Saved nc files')
+        print('  ' + label + ': Time elapsed: %0.1f seconds' % (time.time() - tt0))
+        if ('fail' in results) and (counter < max_tries) and not stop_event.is_set():
+            delay = min(300.0, t0 * 2**(counter-1)) * jitter.uniform(0.5, 1.5)
+            print('  ' + label + ': Trying again in %0.1f seconds' % delay)
+            stop_event.wait(delay)                # sleep, but wake up at once if the run is interrupted
         counter += 1
-    if got_file:
-        result = 'success'
-    else:
-        result = 'fail'
-    return result
+    # remove the temporary nc file of the request and the .part files of the nc files that could not be saved, so that they are not left in the output directory
+    tmp_fns = [read_fn] + [directory + out_name + '.part' for out_name, result in zip(out_names, results) if result == 'fail']
+    for tmp_fn in tmp_fns:
+        try:
+            os.remove(tmp_fn)
+        except FileNotFoundError:
+            pass
+    return results
 
 # - - -
 # make daily dt_list to extract from glorys
 base = datetime.fromisoformat(date_start)
 ndt = number_of_days
-dt_list = []
-dt_list = [base + timedelta(hours=24*x) for x in range(ndt)]
+dt_list = pd.date_range(base, periods=ndt, freq='D')
+
+# group the dates in dt_list into chunks of chunk_days that are each saved by one worker of the thread pool,
+# and make the datetime strings of the first and last day of every chunk all at once
+chunk_list = [dt_list[i:i+chunk_days] for i in range(0, ndt, chunk_days)]
+dstr_min_list = dt_list[0::chunk_days].strftime('%Y-%m-%d 00:00:00')
+dstr_max_list = dt_list[[min(i+chunk_days, ndt)-1 for i in range(0, ndt, chunk_days)]].strftime('%Y-%m-%d 23:59:59')
 
 # prompt for the user name and password of the user account at https://data.marine.copernicus.eu/products
 USERNAME = input('Enter your username: ')
 PASSWORD = getpass.getpass('Enter your password: ')
 
-# template dict that will be updated with new dates and output filenames during each iteration of the loop through days
+# log in once before the loop so that the credentials are checked and cached for all of the downloads
+if not copernicusmarine.login(username=USERNAME, password=PASSWORD, force_overwrite=True):
+    sys.exit('Login to https://data.marine.copernicus.eu/ failed, check your username and password')
+
+# options to open the dataset, subset to the bounding box, depths, and whole period of dt_list
 data_request_options_dict_manual = {
-    "service_id": "GLOBAL_MULTIYEAR_PHY_001_030-TDS",
-    "product_id": "cmems_mod_glo_phy_my_0.083_P1D-m",
-    "date_min": " ",
-    "date_max": " ",
-    "longitude_min": float(west),
-    "longitude_max": float(east),
-    "latitude_min": float(south),
-    "latitude_max": float(north),
-    "depth_min": float(dep_min),
-    "depth_max": float(dep_max),
-    "variable": var_list,
-    "motu": "https://my.cmems-du.eu/motu-web/Motu",
-    "out_dir": OUTPUT_DIRECTORY,
-    "out_name": " ",
-    "auth_mode": "cas",
-    "user": USERNAME,
-    "pwd": PASSWORD
+    "dataset_id": "cmems_mod_glo_phy_my_0.083deg_P1D-m",
+    "variables": var_list,
+    "minimum_longitude": float(west),
+    "maximum_longitude": float(east),
+    "minimum_latitude": float(south),
+    "maximum_latitude": float(north),
+    "minimum_depth": float(dep_min),
+    "maximum_depth": float(dep_max),
+    "start_datetime": dstr_min_list[0],
+    "end_datetime": dstr_max_list[-1],
+    "username": USERNAME,
+    "password": PASSWORD
 }
 
 # - - -
-# loop over all datetimes in dt_list
+# loop over all chunks of datetimes in chunk_list, downloading number_of_workers files at the same time
 out_dir = OUTPUT_DIRECTORY                   # specify output directory adding the ending '/'
 ensure_dir(out_dir)                         # make sure the output directory exists, make one if not
 f = open(out_dir + 'log.txt', 'w+')         # open log of successful downloads
 print('\n** Working on GLORYS extraction **')
 f.write('\n\n** Working on GLORYS extraction **')
 tt1 = time.time()                           # tic for total elapsed time
-force_overwrite = True                      # overwrite any already existing nc files in the output folder that have the same names
-for dt in dt_list:
-
-    out_fn = datetime.strftime(dt, 'glorys_%Y_%m_%d') + '.nc'
-    dstr_min = dt.strftime('%Y-%m-%d 00:00:00')
-    dstr_max = dt.strftime('%Y-%m-%d 23:59:59')
-
-    data_request_options_dict_manual["out_name"] = out_fn
-    data_request_options_dict_manual["date_min"] = dstr_min
-    data_request_options_dict_manual["date_max"] = dstr_max
-
-    print(out_dir + out_fn)
-    if os.path.isfile(out_fn):
-        if force_overwrite:
-            os.remove(out_fn)
-    if not os.path.isfile(out_fn):
-        result = get_extraction(data_request_options_dict_manual)
-        f.write('\n ' + datetime.strftime(dt, '%Y_%m_%d') + ' ' + result)
-            
+force_overwrite = '--resume' not in sys.argv    # overwrite any already existing nc files in the output folder that have the same names, unless the script is run with --resume
+
+# load the manifest of the nc files that were completely downloaded by previous runs, which are skipped when the script is run with --resume
+manifest_fn = out_dir + 'manifest.json'
+manifest = {}
+if os.path.isfile(manifest_fn):
+    with open(manifest_fn) as fm:
+        manifest = json.load(fm)
+
+# make function to save the nc files for one chunk of datetimes, which is run by each worker of the thread pool
+def fetch_chunk(dt_chunk, dstr_min, dstr_max):
+
+    day_fmt = 'glorys_%Y_%m_%d'
+    if split_daily:
+        # one nc file for each day of the chunk (the time slice of one day keeps the time dimension)
+        out_fns = list(dt_chunk.strftime(day_fmt + '.nc'))
+        time_slices = [slice(day, day) for day in dt_chunk.strftime('%Y-%m-%d')]
+        file_days = [[day] for day in dt_chunk.strftime('%Y_%m_%d')]
+    else:
+        # one multi-day nc file that is named with the first and last dates of the chunk
+        out_fn = datetime.strftime(dt_chunk[0], day_fmt)
+        if len(dt_chunk) > 1:
+            out_fn += datetime.strftime(dt_chunk[-1], '_%Y_%m_%d')
+        out_fns = [out_fn + '.nc']
+        time_slices = [slice(dstr_min, dstr_max)]
+        file_days = [list(dt_chunk.strftime('%Y_%m_%d'))]
+
+    # nc files of the chunk that still need to be saved (the nc files that were downloaded by a previous run are skipped with --resume)
+    todo_fns = []
+    todo_slices = []
+    for out_fn, time_slice in zip(out_fns, time_slices):
+        print(out_dir + out_fn)
+        if force_overwrite or not in_manifest(manifest, out_dir, out_fn, var_list):
+            todo_fns.append(out_fn)
+            todo_slices.append(time_slice)
+
+    # read the days of the chunk that are still needed with one request and split them into the nc files locally, all in one call of get_extraction,
+    # so that the same Zarr chunks are not downloaded again for each day and an error while saving any of the nc files is handled there
+    results = {}
+    if len(todo_fns) > 0:
+        ds_chunk = ds_glorys.sel(time=slice(todo_slices[0].start, todo_slices[-1].stop))
+        results = dict(zip(todo_fns, get_extraction(ds_chunk, out_dir, todo_fns, todo_slices)))
+
+    day_results = []                            # result of each day of the chunk for the log (None if the nc file was skipped)
+    new_files = []                              # nc files to add to the manifest
+    for out_fn, days in zip(out_fns, file_days):
+        result = results.get(out_fn)
+        if result == 'success':
+            new_files.append([out_fn, var_list])
+        day_results += [[day, result] for day in days]
+    return day_results, new_files
+
+# open the dataset once, before the thread pool starts, as a lazy xarray dataset from the ARCO (Zarr) store of the Copernicus Marine service.
+# This also sets up the login and connection to the server once for all of the workers, and each worker reads the data of its own chunk with one request
+ds_glorys = copernicusmarine.open_dataset(**data_request_options_dict_manual)
+
+ex = ThreadPoolExecutor(max_workers=number_of_workers)
+try:
+    for day_results, new_files in ex.map(fetch_chunk, chunk_list, dstr_min_list, dstr_max_list):       # results are returned in the same order as chunk_list
+        for dstr, result in day_results:
+            if result is not None:
+                f.write('\n ' + dstr + ' ' + result)
+        for fn, fn_vars in new_files:
+            full_path = os.path.join(out_dir, fn)
+            manifest[fn] = {'size': os.path.getsize(full_path), 'mtime': os.path.getmtime(full_path), 'vars': fn_vars}
+        if len(new_files) > 0:
+            save_manifest(manifest, manifest_fn)
+except KeyboardInterrupt:
+    # Ctrl-C only interrupts the main thread, so cancel the chunks that have not started yet and tell the running workers to stop
+    print('\n*Interrupted, stopping the workers of the thread pool')
+    stop_event.set()
+    ex.shutdown(wait=False, cancel_futures=True)
+    f.close()
+    raise
+ex.shutdown()
+
 # - - -
 # final message
 totmin = (time.time() - tt1)/60             # total time elapsed for loop over all datetimes in minutes